@@ -0,0 +1,30 @@
+"""indexes for favorites lookups and people by homeworld
+
+Revision ID: 9c41e7a05d2b
+Revises: 3b7d2f9c4e1a
+Create Date: 2026-10-19 14:03:27.904115
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from migration_helpers import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision = '9c41e7a05d2b'
+down_revision = '3b7d2f9c4e1a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    create_index_concurrently('ix_favorites_user_id', 'favorites', ['user_id'])
+    create_index_concurrently('ix_favorites_type_enum_external_id', 'favorites', ['type_enum', 'external_id'])
+    create_index_concurrently('ix_people_homeworld', 'people', ['homeworld'])
+
+
+def downgrade():
+    drop_index_concurrently('ix_people_homeworld', 'people')
+    drop_index_concurrently('ix_favorites_type_enum_external_id', 'favorites')
+    drop_index_concurrently('ix_favorites_user_id', 'favorites')
@@ -8,4 +8,6 @@ set -o errexit
 
 pipenv install
 
-pipenv run upgrade
\ No newline at end of file
+pipenv run upgrade
+
+pipenv run check
\ No newline at end of file
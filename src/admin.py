@@ -1,10 +1,22 @@
 import os
+from flask import flash
 from flask_admin import Admin
-from models import db, Users,Favorites,Films,Planets,People
+from flask_admin.actions import action
+from models import db, Users,Favorites,Films,Planets,People,FavoritesType
+from changes import delete_recorded, delete_resources
+from utils import APIException
 from flask_admin.contrib.sqla import ModelView
+from sqlalchemy import UniqueConstraint, and_, or_, text
 from sqlalchemy.orm import RelationshipProperty
 
 class AdminView(ModelView):
+        # Above this many rows (estimated) list pages skip COUNT(*) and OFFSET
+        count_estimate_threshold = 100000
+        # Bulk actions commit every `bulk_batch_size` ids
+        bulk_batch_size = 1000
+        # Remembered page boundaries used for keyset paging
+        cursor_cache_size = 1000
+
         def __init__(self, model, *args, **kwargs):
             self.column_list = [c.key for c in model.__table__.columns]
             for attr_name, attr in model.__mapper__.attrs.items():
@@ -12,7 +24,144 @@ class AdminView(ModelView):
                     self.column_list.append(attr_name)
             self.form_excluded_columns = ["id"]
             self.form_columns = [col for col in self.column_list if col != "id"]
-            super().__init__(model, *args, **kwargs) 
+            self._page_cursors = {}
+            super().__init__(model, *args, **kwargs)
+
+        def _indexed_columns(self):
+            # Pages are ordered by (column, pk), an index only serves that order if
+            # the column is unique or the index is exactly (column, pk). The leading
+            # column of any other index still means a sort of every matching row
+            table = self.model.__table__
+            pk = [c.name for c in table.primary_key.columns]
+            indexed = set(pk)
+            for index in table.indexes:
+                columns = [c.name for c in index.columns]
+                if (index.unique and len(columns) == 1) or columns[1:] == pk:
+                    indexed.add(columns[0])
+            for constraint in table.constraints:
+                if isinstance(constraint, UniqueConstraint) and len(constraint.columns) == 1:
+                    indexed.add(list(constraint.columns)[0].name)
+            for column in table.columns:
+                if column.unique:
+                    indexed.add(column.name)
+            return indexed
+
+        def scaffold_sortable_columns(self):
+            # Sorting on a column without an index means a full table sort
+            indexed = self._indexed_columns()
+            columns = {}
+            for key, column in super().scaffold_sortable_columns().items():
+                if column.name in indexed:
+                    columns[key] = column
+            pk = self.model.__mapper__.primary_key[0]
+            columns.setdefault(pk.key, pk)
+            return columns
+
+        def _estimate_count(self):
+            table = self.model.__tablename__
+            dialect = db.engine.dialect.name
+            try:
+                if dialect == "postgresql":
+                    estimate = db.session.execute(
+                        text("SELECT reltuples::bigint FROM pg_class WHERE relname = :table"),
+                        {"table": table}
+                    ).scalar()
+                    # -1 means the table was never vacuumed/analyzed
+                    return estimate if estimate is not None and estimate >= 0 else None
+                if dialect == "sqlite":
+                    stat = db.session.execute(
+                        text("SELECT stat FROM sqlite_stat1 WHERE tbl = :table LIMIT 1"),
+                        {"table": table}
+                    ).scalar()
+                    return int(stat.split()[0]) if stat else None
+            except Exception:
+                # sqlite_stat1 only exists after ANALYZE
+                db.session.rollback()
+            return None
+
+        def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+            if search or filters:
+                return super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+
+            count = self._estimate_count()
+            if count is None or count < self.count_estimate_threshold:
+                return super().get_list(page, sort_column, sort_desc, search, filters, execute, page_size)
+
+            page = page or 0
+            page_size = page_size if page_size is not None else self.page_size
+            pk = self.model.__mapper__.primary_key[0]
+            column = self._sortable_columns.get(sort_column) if sort_column else None
+            if column is None or column.name == pk.name:
+                column = None
+
+            query = self.get_query()
+            if column is not None:
+                order = [column.desc(), pk.desc()] if sort_desc else [column, pk]
+            else:
+                order = [pk.desc()] if sort_desc else [pk]
+            query = query.order_by(*order)
+
+            cursor_key = (sort_column, bool(sort_desc), page_size)
+            cursor = self._page_cursors.get(cursor_key + (page - 1,)) if page else None
+            if cursor is not None:
+                query = query.filter(self._seek(column, pk, sort_desc, cursor))
+            elif page and page_size:
+                # No remembered boundary (jumped pages), fall back to OFFSET once
+                query = query.offset(page * page_size)
+            if page_size:
+                query = query.limit(page_size)
+
+            if not execute:
+                return count, query
+
+            rows = query.all()
+            if rows and page_size:
+                if len(self._page_cursors) >= self.cursor_cache_size:
+                    self._page_cursors.clear()
+                last = rows[-1]
+                value = getattr(last, column.key) if column is not None else None
+                self._page_cursors[cursor_key + (page,)] = (value, getattr(last, pk.key))
+            return count, rows
+
+        def _seek(self, column, pk, sort_desc, cursor):
+            value, last_pk = cursor
+            if column is None:
+                return pk < last_pk if sort_desc else pk > last_pk
+            if sort_desc:
+                return or_(column < value, and_(column == value, pk < last_pk))
+            return or_(column > value, and_(column == value, pk > last_pk))
+
+        def after_model_change(self, form, model, is_created):
+            self._page_cursors.clear()
+
+        def after_model_delete(self, model):
+            self._page_cursors.clear()
+
+        @action("delete", "Delete", "Are you sure you want to delete selected records?")
+        def action_delete(self, ids):
+            pk = self.model.__mapper__.primary_key[0]
+            table_name = self.model.__tablename__
+            count = 0
+            try:
+                for start in range(0, len(ids), self.bulk_batch_size):
+                    batch = ids[start:start + self.bulk_batch_size]
+                    if table_name in FavoritesType.__members__:
+                        # Same cascade to favorites (and residents) as the API
+                        count += delete_resources(table_name, [int(id) for id in batch])
+                    else:
+                        count += delete_recorded(self.model, pk.in_(batch))
+                    # Commit per batch so one huge selection never holds locks for long
+                    db.session.commit()
+                self._page_cursors.clear()
+                flash("%s records were successfully deleted." % count, "success")
+            except APIException as ex:
+                db.session.rollback()
+                flash("Failed to delete records. %s (%s deleted before the error)" % (ex.message, count), "error")
+            except Exception as ex:
+                db.session.rollback()
+                if not self.handle_view_exception(ex):
+                    raise
+                flash("Failed to delete records. %s (%s deleted before the error)" % (ex, count), "error")
 
 def setup_admin(app):
     app.secret_key = os.environ.get('FLASK_APP_KEY', 'sample key')
@@ -2,18 +2,25 @@
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
 """
 import os
+import hmac
 import bcrypt
 
 from utils import APIException, generate_sitemap
 from admin import setup_admin
+from jobs import setup_jobs, enqueue, JOB_HANDLERS
+from catalog import setup_catalog, get_snapshot
+from migration_helpers import schema_cli
+from changes import setup_changes, delete_resources, purged_seq, head_seq
+from profiler import setup_profiler, start_window, collapsed, snapshot, reset, WORKER_ROUTE
 
 from flask import Flask, request, jsonify, url_for
+from werkzeug.exceptions import HTTPException
 from flask_migrate import Migrate
 from flask_swagger import swagger
 from flask_cors import CORS
 from sqlalchemy import or_
 
-from models import db, Users,Favorites,Films,Planets,People,FavoritesType
+from models import db, Users,Favorites,Films,Planets,People,FavoritesType,Jobs,Changes
 from flask_jwt_extended import create_access_token,get_jwt_identity,jwt_required,JWTManager,set_access_cookies,unset_jwt_cookies,get_jwt_identity
 
 
@@ -32,11 +39,26 @@ app.config["JWT_TOKEN_LOCATION"] = ["cookies"]
 app.config["JWT_SECRET_KEY"] = "cO48sKPDnc3cbbnAqwq"  # Change this!
 jwt = JWTManager(app)
 
+# What deleting a planet does to the people living on it: "restrict" or "cascade"
+app.config["HOMEWORLD_DELETE_POLICY"] = os.getenv("HOMEWORLD_DELETE_POLICY", "restrict")
+if app.config["HOMEWORLD_DELETE_POLICY"] not in ("restrict", "cascade"):
+    raise ValueError("HOMEWORLD_DELETE_POLICY must be 'restrict' or 'cascade', got %r" % app.config["HOMEWORLD_DELETE_POLICY"])
+
+# Serve films/planets/people reads from a per-worker in-memory snapshot
+app.config["CATALOG_SNAPSHOT"] = os.getenv("CATALOG_SNAPSHOT") == "1"
+app.config["CATALOG_CHECK_SECONDS"] = float(os.getenv("CATALOG_CHECK_SECONDS", 1))
+app.config["CATALOG_MAX_AGE_SECONDS"] = float(os.getenv("CATALOG_MAX_AGE_SECONDS", 60))
+
 MIGRATE = Migrate(app, db)
 db.init_app(app)
 app.config['CORS_HEADERS'] = 'Content-Type'
 CORS(app,supports_credentials=True)
 setup_admin(app)
+setup_jobs(app)
+app.cli.add_command(schema_cli)
+setup_profiler(app)
+setup_changes(app)
+setup_catalog(app)
 
 # Handle/serialize errors like a JSON object
 @app.errorhandler(APIException)
@@ -55,6 +77,17 @@ tables = {
     }
 
 
+def catalog_all(table_name):
+    if app.config["CATALOG_SNAPSHOT"]:
+        return get_snapshot(app).tables[table_name].all()
+    return tables[table_name].query.all()
+
+def catalog_get(table_name, id):
+    if app.config["CATALOG_SNAPSHOT"]:
+        return get_snapshot(app).tables[table_name].get(id)
+    return tables[table_name].query.get(id)
+
+
 @app.route('/register',methods=['POST'])
 def register():
     data = request.get_json()
@@ -193,7 +226,7 @@ def handle_favorites(user_id):
 
 @app.route('/films',methods=['GET'])
 def get_films():
-    films_list = Films.query.all()
+    films_list = catalog_all("films")
     response_body = {
         "content": films_list
     }
@@ -201,7 +234,7 @@ def get_films():
 
 @app.route('/films/<int:id>',methods=['GET'])
 def get_film(id):
-    film = Films.query.get(id)
+    film = catalog_get("films",id)
     response_body = {
         "content": film
     }
@@ -229,20 +262,16 @@ def post_film():
 
 @app.route('/films/<int:id>',methods=['DELETE'])
 def delete_film(id):
-    film = Films.query.get(id)
-    if not film:
+    if not delete_resources("films",[id]):
         return jsonify({"message":"No film found with the requested id"}),400
 
-    db.session.delete(film)
-    db.session.commit()
-
     return jsonify({"message": "Film deleted successfully"}),200
 
                                          # GET,POST & DELETE PLANETS
 
 @app.route('/planets',methods=['GET'])
 def get_planets():
-    planets_list = Planets.query.all()
+    planets_list = catalog_all("planets")
     response_body = {
         "content": planets_list
     }
@@ -250,7 +279,7 @@ def get_planets():
 
 @app.route('/planets/<int:id>',methods=['GET'])
 def get_planet(id):
-    planet = Planets.query.get(id)
+    planet = catalog_get("planets",id)
     response_body = {
         "content": planet
     }
@@ -277,20 +306,16 @@ def post_planet():
 
 @app.route('/planets/<int:id>',methods=['DELETE'])
 def delete_planet(id):
-    planet = Planets.query.get(id)
-    if not planet:
+    if not delete_resources("planets",[id]):
         return jsonify({"message":"No planet found with the requested id"}),400
 
-    db.session.delete(planet)
-    db.session.commit()
-
     return jsonify({"message": "Planet deleted successfully"}),200
 
 
                                             # GET,POST & DELETE PEOPLE
 @app.route('/people',methods=['GET'])
 def get_people():
-    people_list = People.query.all()
+    people_list = catalog_all("people")
     response_body = {
         "content": people_list
     }
@@ -299,7 +324,7 @@ def get_people():
 
 @app.route('/people/<int:id>',methods=['GET'])
 def get_person(id):
-    person = People.query.get(id)
+    person = catalog_get("people",id)
     response_body = {
         "content": person
     }
@@ -327,15 +352,212 @@ def post_person():
 
 @app.route('/person/<int:id>',methods=['DELETE'])
 def delete_person(id):
-    person = People.query.get(id)
-    if not person:
+    if not delete_resources("people",[id]):
         return jsonify({"message":"No person found with the requested id"}),400
 
-    db.session.delete(person)
-    db.session.commit()
-
     return jsonify({"message": "Person deleted successfully"}),200
 
+@app.route('/films',methods=['DELETE'],defaults={"table": "films"})
+@app.route('/planets',methods=['DELETE'],defaults={"table": "planets"})
+@app.route('/people',methods=['DELETE'],defaults={"table": "people"})
+@jwt_required()
+def delete_many(table):
+    try:
+        ids = [int(id) for value in request.args.getlist("ids") for id in value.split(",") if id]
+    except ValueError:
+        return jsonify({"message":"ids must be a comma separated list of integers"}),400
+    if not ids:
+        return jsonify({"message":"error","missing fields" : ["ids"]}),400
+
+    deleted = delete_resources(table,ids)
+    return jsonify({"message": "Deleted successfully","deleted": deleted}),200
+
+@app.route('/catalog/snapshot',methods=['GET'])
+def get_catalog_snapshot():
+    if not app.config["CATALOG_SNAPSHOT"]:
+        return jsonify({"message":"Catalog snapshot is disabled"}),404
+    return jsonify(get_snapshot(app).stats()),200
+
+                                            # CHANGE FEED
+
+CHANGES_MAX_LIMIT = 1000
+
+@app.route('/changes',methods=['GET'])
+@jwt_required(optional=True)
+def get_changes():
+    since = request.args.get("since", 0, type=int)
+    limit = max(1, min(request.args.get("limit", 100, type=int), CHANGES_MAX_LIMIT))
+    purged = purged_seq()
+    # A client starting from 0 has no rows to delete, compaction kept the latest
+    # entry of every other row. Others missed purged deletes and must reload,
+    # then resume from the head seq read before reloading.
+    if 0 < since < purged:
+        return jsonify({
+            "error":"Changes since this seq were compacted, full resync required",
+            "purged_seq": purged,
+            "head": head_seq()
+        }),410
+
+    user_id = get_jwt_identity()
+    visible = Changes.user_id.is_(None)
+    if user_id is not None:
+        visible = or_(visible, Changes.user_id == int(user_id))
+    changes = Changes.query.filter(Changes.seq > since, visible).order_by(Changes.seq).limit(limit + 1).all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    response_body = {
+        "content": changes,
+        "next": changes[-1].seq if changes else since,
+        "has_more": has_more
+    }
+    return jsonify(response_body),200
+
+                                            # PROFILING
+
+def profile_authorized():
+    token = app.config["PROFILE_TOKEN"]
+    return bool(token) and hmac.compare_digest(request.headers.get("X-Profile-Token", ""), token)
+
+PROFILE_MAX_WINDOW_SECONDS = 600
+
+@app.route('/profile',methods=['GET'])
+def get_profile():
+    if not profile_authorized():
+        return jsonify({"message":"Not found"}),404
+    return collapsed(snapshot(request.args.get("route"))),200,{"Content-Type": "text/plain; charset=utf-8"}
+
+@app.route('/profile',methods=['POST'])
+def post_profile():
+    """Samples every thread of this worker for ?seconds=N in the background,
+    read the result later with GET /profile?route=[worker]"""
+    if not profile_authorized():
+        return jsonify({"message":"Not found"}),404
+    seconds = request.args.get("seconds", type=float)
+    if not seconds or not 0 < seconds <= PROFILE_MAX_WINDOW_SECONDS:
+        return jsonify({"error":"seconds must be between 0 and %s" % PROFILE_MAX_WINDOW_SECONDS}),400
+    if not start_window(seconds, app.config["PROFILE_INTERVAL"]):
+        return jsonify({"error":"A profiling window is already running"}),409
+    return jsonify({"message":"Profiling started","seconds": seconds,"route": WORKER_ROUTE}),202
+
+@app.route('/profile',methods=['DELETE'])
+def delete_profile():
+    if not profile_authorized():
+        return jsonify({"message":"Not found"}),404
+    reset()
+    return jsonify({"message":"Profile data cleared"}),200
+
+                                            # BATCH
+
+BATCH_MAX_REQUESTS = 50
+
+# Single-row GET endpoints whose lookups are coalesced into one IN query per table
+batch_lookups = {
+    "get_user": Users,
+    "get_film": Films,
+    "get_planet": Planets,
+    "get_person": People
+}
+
+def dispatch_sub_request(path, query_string):
+    # Own GET request context (views branch on request.method) sharing the
+    # caller's cookies/auth and, through the app context, the same DB session
+    headers = {k: v for k, v in request.headers.items() if k not in ("Content-Type", "Content-Length")}
+    with app.test_request_context(path, method="GET", headers=headers, query_string=query_string):
+        response = app.make_response(app.full_dispatch_request())
+    return {"status": response.status_code, "body": response.get_json(silent=True)}
+
+@app.route('/batch',methods=['POST'])
+def batch():
+    data = request.get_json(force=True)
+    sub_requests = data.get("requests") if isinstance(data, dict) else None
+    if not isinstance(sub_requests, list):
+        return jsonify({"message":"error","missing fields" : ["requests"]}),400
+    if len(sub_requests) > BATCH_MAX_REQUESTS:
+        return jsonify({"error":"Too many requests in batch","max": BATCH_MAX_REQUESTS}),400
+
+    adapter = app.create_url_adapter(request)
+    matched = []
+    wanted = {}
+    for sub_request in sub_requests:
+        if not isinstance(sub_request, dict):
+            sub_request = {}
+        path = sub_request.get("path")
+        method = sub_request.get("method", "GET")
+        # Only reads are batched, writes keep their own request/transaction
+        if not isinstance(path, str) or not path.startswith("/") or not isinstance(method, str) or method.upper() != "GET":
+            matched.append(({"status": 400, "body": {"error": "Only GET sub-requests with a path are allowed"}}, None, None, None))
+            continue
+        path, _, query_string = path.partition("?")
+        try:
+            endpoint, view_args = adapter.match(path, method="GET")
+        except HTTPException as e:
+            matched.append(({"status": e.code, "body": {"error": e.description}}, None, None, None))
+            continue
+        if endpoint in batch_lookups:
+            wanted.setdefault(endpoint, set()).update(view_args.values())
+        matched.append((None, endpoint, view_args, (path, query_string)))
+
+    found = {}
+    for endpoint, ids in wanted.items():
+        model = batch_lookups[endpoint]
+        if app.config["CATALOG_SNAPSHOT"] and model.__tablename__ in tables:
+            # Same source as the single-row endpoint, the snapshot when it's enabled
+            found[endpoint] = {id: catalog_get(model.__tablename__, id) for id in ids}
+            continue
+        pk = model.__mapper__.primary_key[0]
+        found[endpoint] = {getattr(row, pk.key): row for row in model.query.filter(pk.in_(ids))}
+
+    responses = []
+    for response, endpoint, view_args, target in matched:
+        if response is None and endpoint in batch_lookups:
+            # Same body the single-row endpoint returns, including a null content
+            row = found[endpoint].get(next(iter(view_args.values())))
+            response = {"status": 200, "body": {"content": row}}
+        elif response is None:
+            response = dispatch_sub_request(*target)
+        responses.append(response)
+
+    return jsonify(responses),200
+
+                                            # BACKGROUND JOBS
+
+JOB_MAX_ATTEMPTS = 10
+
+@app.route('/jobs',methods=['POST'])
+@jwt_required()
+def post_job():
+    data = request.get_json(force=True)
+    if not isinstance(data, dict):
+        return jsonify({"error":"Body must be a JSON object"}),400
+    if "kind" not in data:
+        return jsonify({"message":"error","missing fields" : ["kind"]}),400
+    if data["kind"] not in JOB_HANDLERS:
+        return jsonify({"error":"Invalid kind. Must be one of","kinds": sorted(JOB_HANDLERS)}),400
+
+    max_attempts = data.get("max_attempts",3)
+    if type(max_attempts) is not int or not 1 <= max_attempts <= JOB_MAX_ATTEMPTS:
+        return jsonify({"error":"max_attempts must be an integer between 1 and %s" % JOB_MAX_ATTEMPTS}),400
+
+    # Handlers read their options with payload.get(), anything else fails on every attempt
+    payload = data.get("payload")
+    if payload is not None and not isinstance(payload, dict):
+        return jsonify({"error":"payload must be a JSON object"}),400
+
+    new_job = enqueue(data["kind"],payload,max_attempts)
+    return jsonify(new_job),202
+
+@app.route('/jobs/<int:id>',methods=['GET'])
+@jwt_required()
+def get_job(id):
+    job = Jobs.query.get(id)
+    if not job:
+        return jsonify({"message":"No job found with the requested id"}),404
+    response_body = {
+        "content": job
+    }
+    return jsonify(response_body),200
+
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
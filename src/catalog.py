@@ -0,0 +1,149 @@
+"""
+Optional in-memory read path for the small, read-mostly catalog tables.
+Each worker keeps one immutable snapshot and swaps in a new one when the
+version query shows the tables changed.
+"""
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from sqlalchemy import event, func, select
+
+from models import db, Films, Planets, People, Changes
+
+catalog_models = {
+    "films": Films,
+    "planets": Planets,
+    "people": People
+}
+
+
+class TableSnapshot:
+    __slots__ = ("columns", "ids", "rows")
+
+    def __init__(self, model):
+        self.columns = tuple(c.key for c in model.__table__.columns)
+        result = db.session.query(*model.__table__.columns).order_by(model.id).all()
+        # Sorted ids in a typed array, rows at the same position
+        self.ids = array("q", (row.id for row in result))
+        self.rows = tuple(tuple(row) for row in result)
+
+    def get(self, id):
+        position = bisect_left(self.ids, id)
+        if position < len(self.ids) and self.ids[position] == id:
+            return dict(zip(self.columns, self.rows[position]))
+        return None
+
+    def all(self):
+        return [dict(zip(self.columns, row)) for row in self.rows]
+
+    def memory_usage(self):
+        size = sys.getsizeof(self.ids) + sys.getsizeof(self.rows) + sys.getsizeof(self.columns)
+        for row in self.rows:
+            size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+        return size
+
+
+class CatalogSnapshot:
+    __slots__ = ("version", "loaded_at", "tables")
+
+    def __init__(self, version):
+        self.version = version
+        self.loaded_at = time.time()
+        self.tables = {name: TableSnapshot(model) for name, model in catalog_models.items()}
+
+    def stats(self):
+        return {
+            "version": list(self.version),
+            "loaded_at": self.loaded_at,
+            "tables": {name: {"rows": len(table.rows), "bytes": table.memory_usage()}
+                       for name, table in self.tables.items()}
+        }
+
+
+_snapshot = None
+_checked_at = 0
+# Bumped by local catalog writes, a snapshot checked before the bump is re-checked
+_generation = 0
+_checked_generation = 0
+_refresh_lock = threading.Lock()
+
+
+def catalog_version():
+    # One round trip: row count and max id of every catalog table, plus its last
+    # change feed seq, which also moves on in-place updates. One MAX per table so
+    # each is a single seek on ix_changes_table_name_seq
+    columns = []
+    for name, model in catalog_models.items():
+        columns.append(select(func.max(Changes.seq)).where(Changes.table_name == name).scalar_subquery())
+        columns.append(select(func.count(model.id)).scalar_subquery())
+        columns.append(select(func.max(model.id)).scalar_subquery())
+    return tuple(db.session.execute(select(*columns)).one())
+
+
+def get_snapshot(app):
+    """Returns the current snapshot, checking the version at most every
+    CATALOG_CHECK_SECONDS (or right after a write from this worker) and reloading
+    at least every CATALOG_MAX_AGE_SECONDS (writes that bypass the ORM and the
+    change feed are only seen then)."""
+    global _snapshot, _checked_at, _checked_generation
+    now = time.time()
+    snapshot = _snapshot
+    invalidated = _checked_generation != _generation
+    if snapshot is not None and not invalidated and now - _checked_at < app.config["CATALOG_CHECK_SECONDS"]:
+        return snapshot
+
+    # Only one thread refreshes, the others keep serving the old snapshot unless
+    # this worker wrote to the catalog, then they wait to read their own write
+    if not _refresh_lock.acquire(blocking=snapshot is None or invalidated):
+        return snapshot
+    try:
+        generation = _generation
+        if _checked_generation == generation and _snapshot is not snapshot:
+            return _snapshot
+        snapshot = _snapshot
+        version = catalog_version()
+        expired = snapshot is not None and now - snapshot.loaded_at > app.config["CATALOG_MAX_AGE_SECONDS"]
+        if snapshot is None or snapshot.version != version or expired:
+            snapshot = CatalogSnapshot(version)
+            _snapshot = snapshot
+            app.logger.info("Catalog snapshot loaded: %s", snapshot.stats()["tables"])
+        _checked_at = now
+        _checked_generation = generation
+        return snapshot
+    finally:
+        _refresh_lock.release()
+
+
+def invalidate():
+    global _generation
+    _generation += 1
+
+
+def _track_flush(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if obj.__tablename__ in catalog_models:
+            session.info["catalog_changed"] = True
+            return
+
+
+def _track_bulk(orm_execute_state):
+    # query.delete()/update() skip the flush, e.g. the set-based deletes
+    if orm_execute_state.is_delete or orm_execute_state.is_update:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None and mapper.local_table.name in catalog_models:
+            orm_execute_state.session.info["catalog_changed"] = True
+
+
+def _track_commit(session):
+    if session.info.pop("catalog_changed", False):
+        invalidate()
+
+
+def setup_catalog(app):
+    event.listen(db.session, "after_flush", _track_flush)
+    event.listen(db.session, "do_orm_execute", _track_bulk)
+    event.listen(db.session, "after_commit", _track_commit)
+    event.listen(db.session, "after_rollback", lambda session: session.info.pop("catalog_changed", None))
@@ -0,0 +1,176 @@
+"""
+Change feed: every insert, update and delete of the catalog tables and favorites is
+written to `changes` in the same transaction, with a monotonically increasing seq.
+ORM writes (API and admin) are captured by an after_flush hook; set-based deletes
+must go through delete_recorded(), or delete_resources() for the catalog tables.
+
+Seqs come from the single changes_counter row, whose lock is held until the writing
+transaction ends, so entries become visible in seq order and a reader that has seen
+seq N never misses an entry below N.
+"""
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import DDL, event, func, insert, literal, null, select, update
+
+from models import db, Changes, ChangesCounter, ChangesCompactions, Films, Planets, People, Favorites, FavoritesType
+from jobs import job
+from utils import APIException
+
+tracked_models = {
+    "films": Films,
+    "planets": Planets,
+    "people": People,
+    "favorites": Favorites
+}
+
+changes_cli = AppGroup('changes', help="Change feed commands")
+
+
+def _row_data(obj):
+    return {c.key: getattr(obj, c.key) for c in obj.__table__.columns}
+
+
+def reserve_seqs(connection, count):
+    """Reserves `count` seqs and returns the first one. Row-locks the counter until
+    the transaction ends, which serializes writers of the change feed (a count of 0
+    only takes the lock)."""
+    reserved = connection.execute(
+        update(ChangesCounter).where(ChangesCounter.id == 1).values(seq=ChangesCounter.seq + count)
+    ).rowcount
+    if not reserved:
+        raise RuntimeError("changes_counter has no row, run the migrations")
+    return connection.execute(select(ChangesCounter.seq).where(ChangesCounter.id == 1)).scalar() - count + 1
+
+
+# The migration seeds the counter row, this does the same for create_all
+event.listen(ChangesCounter.__table__, "after_create", DDL("INSERT INTO changes_counter (id, seq) VALUES (1, 0)"))
+
+
+def _entry(op, obj, with_data=True):
+    pk = obj.__mapper__.primary_key[0]
+    return {
+        "table_name": obj.__tablename__,
+        "op": op,
+        "row_id": getattr(obj, pk.key),
+        "data": _row_data(obj) if with_data else None,
+        # Favorites are private, /changes only returns them to their owner
+        "user_id": getattr(obj, "user_id", None) if isinstance(obj, Favorites) else None,
+    }
+
+
+def record_flush(session, flush_context):
+    # new/dirty/deleted still hold the pre-flush state here, with ids assigned
+    entries = []
+    for obj in session.new:
+        if obj.__tablename__ in tracked_models:
+            entries.append(_entry("insert", obj))
+    for obj in session.dirty:
+        if obj.__tablename__ in tracked_models and session.is_modified(obj, include_collections=False):
+            entries.append(_entry("update", obj))
+    for obj in session.deleted:
+        if obj.__tablename__ in tracked_models:
+            entries.append(_entry("delete", obj, with_data=False))
+    if entries:
+        connection = session.connection()
+        first = reserve_seqs(connection, len(entries))
+        for number, entry in enumerate(entries):
+            entry["seq"] = first + number
+        connection.execute(insert(Changes), entries)
+
+
+def delete_recorded(model, *criteria):
+    """DELETE ... WHERE criteria, preceded by an INSERT ... SELECT of the matching
+    ids into the change log. Neither statement loads rows into Python."""
+    pk = model.__mapper__.primary_key[0]
+    user_id = model.user_id if model is Favorites else null()
+    if model.__tablename__ in tracked_models:
+        connection = db.session.connection()
+        # Lock the counter before reading the matching rows. Every writer of the feed
+        # reserves seqs in its flush, so no matching row can commit between the two
+        # statements, and the recorded set is the deleted set
+        first = reserve_seqs(connection, 0)
+        seq = literal(first - 1) + func.row_number().over(order_by=pk)
+        recorded = db.session.execute(insert(Changes).from_select(
+            ["seq", "table_name", "op", "row_id", "user_id"],
+            select(seq, literal(model.__tablename__), literal("delete"), pk, user_id).where(*criteria)
+        )).rowcount
+        if recorded:
+            reserve_seqs(connection, recorded)
+    return model.query.filter(*criteria).delete(synchronize_session=False)
+
+
+def delete_resources(table_name, ids):
+    """Deletes the given ids from a catalog table with set-based statements,
+    cascading to Favorites (and People on a deleted homeworld) in the same transaction."""
+    model = tracked_models[table_name]
+    policy = current_app.config["HOMEWORLD_DELETE_POLICY"]
+
+    if table_name == "planets":
+        residents = db.session.query(People.id).filter(People.homeworld.in_(ids))
+        if policy == "cascade":
+            delete_recorded(
+                Favorites,
+                Favorites.type_enum == FavoritesType.people,
+                Favorites.external_id.in_(residents.scalar_subquery())
+            )
+            delete_recorded(People, People.homeworld.in_(ids))
+        elif db.session.query(residents.exists()).scalar():
+            raise APIException("Planets still referenced as homeworld by people", status_code=409)
+
+    delete_recorded(
+        Favorites,
+        Favorites.type_enum == FavoritesType(table_name),
+        Favorites.external_id.in_(ids)
+    )
+    deleted = delete_recorded(model, model.id.in_(ids))
+    db.session.commit()
+    return deleted
+
+
+def purged_seq():
+    return db.session.query(func.max(ChangesCompactions.purged_seq)).scalar() or 0
+
+
+def head_seq():
+    # Not MAX(changes.seq), the newest entry may be a purged tombstone
+    return db.session.query(ChangesCounter.seq).filter(ChangesCounter.id == 1).scalar() or 0
+
+
+def compact(retention_days):
+    """Keeps only the latest entry per row, then drops delete tombstones older than
+    the retention. Clients asking for changes after 0 but before the dropped
+    tombstones get a 410."""
+    latest = select(func.max(Changes.seq)).group_by(Changes.table_name, Changes.row_id)
+    collapsed = Changes.query.filter(Changes.seq.not_in(latest)).delete(synchronize_session=False)
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    old_tombstones = Changes.query.filter(Changes.op == "delete", Changes.created_at < cutoff)
+    newest_purged = old_tombstones.with_entities(func.max(Changes.seq)).scalar()
+    purged = 0
+    if newest_purged is not None:
+        purged = old_tombstones.delete(synchronize_session=False)
+        db.session.add(ChangesCompactions(purged_seq=newest_purged))
+    db.session.commit()
+    return {"collapsed": collapsed, "purged": purged}
+
+
+@job("changes_compact")
+def compact_job(payload, progress):
+    return compact(payload.get("retention_days", int(os.environ.get("CHANGES_RETENTION_DAYS", 7))))
+
+
+@changes_cli.command('compact')
+@click.option('--retention-days', default=None, type=int, help="Keep delete tombstones this many days")
+def compact_command(retention_days):
+    if retention_days is None:
+        retention_days = int(os.environ.get("CHANGES_RETENTION_DAYS", 7))
+    click.echo(compact(retention_days))
+
+
+def setup_changes(app):
+    event.listen(db.session, "after_flush", record_flush)
+    app.cli.add_command(changes_cli)
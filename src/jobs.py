@@ -0,0 +1,236 @@
+"""
+Small durable job runner: jobs live in the `jobs` table and are picked up by worker
+threads started on the first request served (JOB_WORKERS) or by `flask jobs worker`.
+A job is retried until max_attempts, and a job whose worker died is picked up again
+once its lease expires, so handlers must be safe to run more than once.
+"""
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, func, or_, select
+
+from models import db, Jobs, JobStatus, Films, Planets, People
+
+JOB_HANDLERS = {}
+
+jobs_cli = AppGroup('jobs', help="Background job commands")
+
+
+def job(kind):
+    def register(handler):
+        JOB_HANDLERS[kind] = handler
+        return handler
+    return register
+
+
+def enqueue(kind, payload=None, max_attempts=3):
+    new_job = Jobs(kind=kind, payload=payload, status=JobStatus.queued, max_attempts=max_attempts)
+    db.session.add(new_job)
+    db.session.commit()
+    return new_job
+
+
+def _lease_expired(lease_expired):
+    return and_(Jobs.status == JobStatus.running, Jobs.locked_at < lease_expired)
+
+
+def _claimable(lease_expired):
+    return or_(
+        Jobs.status == JobStatus.queued,
+        and_(_lease_expired(lease_expired), Jobs.attempts < Jobs.max_attempts)
+    )
+
+
+def fail_abandoned(lease_expired):
+    # The worker died (OOM, killed on timeout) during the last allowed attempt
+    failed = Jobs.query.filter(_lease_expired(lease_expired), Jobs.attempts >= Jobs.max_attempts).update({
+        "status": JobStatus.failed,
+        "locked_at": None,
+        "error": "Lease expired on the last attempt, the worker running it probably died",
+    }, synchronize_session=False)
+    if failed:
+        db.session.commit()
+    return failed
+
+
+def claim_job(lease_seconds):
+    now = datetime.utcnow()
+    lease_expired = now - timedelta(seconds=lease_seconds)
+    fail_abandoned(lease_expired)
+    condition = _claimable(lease_expired)
+    candidate = db.session.query(Jobs.id).filter(condition).order_by(Jobs.id).first()
+    if candidate is None:
+        db.session.rollback()
+        return None
+
+    # The same condition in the UPDATE makes the claim atomic between workers
+    claimed = Jobs.query.filter(Jobs.id == candidate.id, condition).update({
+        "status": JobStatus.running,
+        "locked_at": now,
+        "attempts": Jobs.attempts + 1,
+    }, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        return None
+    return Jobs.query.get(candidate.id)
+
+
+def run_job(current_job):
+    handler = JOB_HANDLERS.get(current_job.kind)
+    job_id = current_job.id
+
+    def progress(percent):
+        # Also works as a heartbeat so long jobs keep their lease
+        Jobs.query.filter_by(id=job_id).update(
+            {"progress": int(percent), "locked_at": datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+    try:
+        if handler is None:
+            raise ValueError("Unknown job kind %r" % current_job.kind)
+        result = handler(current_job.payload or {}, progress)
+    except Exception:
+        db.session.rollback()
+        current_job = Jobs.query.get(job_id)
+        current_job.error = traceback.format_exc()
+        current_job.locked_at = None
+        if handler is not None and current_job.attempts < current_job.max_attempts:
+            current_job.status = JobStatus.queued
+        else:
+            current_job.status = JobStatus.failed
+        db.session.commit()
+        return
+
+    current_job = Jobs.query.get(job_id)
+    current_job.status = JobStatus.done
+    current_job.result = result
+    current_job.progress = 100
+    current_job.error = None
+    current_job.locked_at = None
+    db.session.commit()
+
+
+def work(app, stop_event=None, poll_seconds=None, lease_seconds=None):
+    poll_seconds = poll_seconds or app.config["JOB_POLL_SECONDS"]
+    lease_seconds = lease_seconds or app.config["JOB_LEASE_SECONDS"]
+    while stop_event is None or not stop_event.is_set():
+        with app.app_context():
+            try:
+                current_job = claim_job(lease_seconds)
+                if current_job is not None:
+                    run_job(current_job)
+                    continue
+            except Exception:
+                app.logger.exception("Job worker error")
+                db.session.rollback()
+        time.sleep(poll_seconds)
+
+
+def start_workers(app, count):
+    stop_event = threading.Event()
+    for number in range(count):
+        thread = threading.Thread(target=work, args=(app, stop_event), name="job-worker-%s" % number, daemon=True)
+        thread.start()
+    return stop_event
+
+
+@jobs_cli.command('worker')
+@click.option('--threads', default=1, help="Number of worker threads")
+def worker_command(threads):
+    from flask import current_app
+    app = current_app._get_current_object()
+    stop_event = start_workers(app, threads)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+def setup_jobs(app):
+    app.config.setdefault("JOB_POLL_SECONDS", float(os.environ.get("JOB_POLL_SECONDS", 1)))
+    app.config.setdefault("JOB_LEASE_SECONDS", int(os.environ.get("JOB_LEASE_SECONDS", 300)))
+    app.config.setdefault("JOB_WORKERS", int(os.environ.get("JOB_WORKERS", 0)))
+    app.cli.add_command(jobs_cli)
+
+    started = []
+    start_lock = threading.Lock()
+
+    # Started on the first request, so importing the app for `flask db upgrade`,
+    # `flask schema check` or `flask jobs worker` never runs in-app workers
+    @app.before_request
+    def start_in_app_workers():
+        if started or not app.config["JOB_WORKERS"]:
+            return
+        with start_lock:
+            if not started:
+                started.append(start_workers(app, app.config["JOB_WORKERS"]))
+
+
+# Built-in jobs
+
+catalog = {
+    "films": Films,
+    "planets": Planets,
+    "people": People
+}
+
+
+@job("catalog_export")
+def export_catalog(payload, progress):
+    result = {}
+    for number, (name, model) in enumerate(catalog.items()):
+        columns = model.__table__.columns
+        # Plain dicts, the JSON result column can't hold model instances
+        result[name] = [{c.key: getattr(row, c.key) for c in columns} for row in model.query.order_by(model.id)]
+        progress((number + 1) * 100 / len(catalog))
+    return result
+
+
+def _advance_sequence(model):
+    # Explicit ids don't advance a Postgres serial sequence, later inserts would reuse them
+    if db.engine.dialect.name == "postgresql":
+        db.session.execute(select(func.setval(
+            func.pg_get_serial_sequence(model.__tablename__, "id"),
+            func.coalesce(select(func.max(model.id)).scalar_subquery(), 0) + 1,
+            False
+        )))
+
+
+@job("catalog_import")
+def import_catalog(payload, progress):
+    # Planets first, people reference them through homeworld
+    names = [name for name in ("films", "planets", "people") if name in payload]
+    total = sum(len(payload[name]) for name in names) or 1
+    done = 0
+    imported = {}
+    for name in sorted(names, key=lambda n: n != "planets"):
+        model = catalog[name]
+        rows = payload[name]
+        for start in range(0, len(rows), 500):
+            batch = rows[start:start + 500]
+            # Skip ids and (unique) names that already exist so a retried job doesn't
+            # fail on duplicates, rows without an id included
+            ids = [row["id"] for row in batch if "id" in row]
+            names = [row["name"] for row in batch if "name" in row]
+            existing_ids = set(id for (id,) in db.session.query(model.id).filter(model.id.in_(ids))) if ids else set()
+            existing_names = set(
+                name for (name,) in db.session.query(model.name).filter(model.name.in_(names))) if names else set()
+            new_rows = [row for row in batch
+                        if row.get("id") not in existing_ids and row.get("name") not in existing_names]
+            # ORM inserts (not bulk_insert_mappings) so the change feed records them.
+            # Rows with an id first, then the sequence is moved past them for the rest
+            db.session.add_all([model(**row) for row in new_rows if "id" in row])
+            db.session.flush()
+            _advance_sequence(model)
+            db.session.add_all([model(**row) for row in new_rows if "id" not in row])
+            db.session.commit()
+            done += len(batch)
+            progress(done * 100 / total)
+        imported[name] = len(rows)
+    return {"imported": imported}
@@ -0,0 +1,142 @@
+"""
+Helpers for migrations on large tables and a models vs. migrations drift check.
+
+Use them from a revision under migrations/versions/:
+
+    from migration_helpers import create_index_concurrently, backfill
+"""
+import logging
+import sys
+import time
+
+import click
+from alembic import op
+from alembic.autogenerate import compare_metadata
+from alembic.config import Config
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import text
+
+BACKFILL_TABLE = "migration_backfills"
+
+schema_cli = AppGroup('schema', help="Schema checks")
+
+logger = logging.getLogger('alembic.migration_helpers')
+
+
+def create_index_concurrently(index_name, table_name, columns, unique=False):
+    """CREATE INDEX CONCURRENTLY on Postgres (no write lock), a plain index elsewhere."""
+    bind = op.get_bind()
+    if bind.dialect.name == "postgresql":
+        # CONCURRENTLY can't run inside the migration transaction
+        with op.get_context().autocommit_block():
+            # A failed concurrent build leaves an INVALID index behind, which
+            # IF NOT EXISTS would skip, so drop it and build it again
+            valid = bind.execute(text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND pg_table_is_visible(c.oid)"
+            ), {"name": index_name}).scalar()
+            if valid is False:
+                logger.warning("Index %s is invalid, rebuilding it", index_name)
+                op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+            op.create_index(index_name, table_name, columns, unique=unique,
+                            postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index(index_name, table_name, columns, unique=unique, if_not_exists=True)
+
+
+def drop_index_concurrently(index_name, table_name):
+    if op.get_bind().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.drop_index(index_name, table_name=table_name, postgresql_concurrently=True, if_exists=True)
+    else:
+        op.drop_index(index_name, table_name=table_name, if_exists=True)
+
+
+def _backfill_position(bind, name):
+    bind.execute(text(
+        "CREATE TABLE IF NOT EXISTS %s (name VARCHAR(100) PRIMARY KEY, last_id BIGINT NOT NULL)" % BACKFILL_TABLE))
+    last_id = bind.execute(text("SELECT last_id FROM %s WHERE name = :name" % BACKFILL_TABLE),
+                           {"name": name}).scalar()
+    if last_id is None:
+        bind.execute(text("INSERT INTO %s (name, last_id) VALUES (:name, 0)" % BACKFILL_TABLE), {"name": name})
+        last_id = 0
+    return last_id
+
+
+def backfill(name, table_name, set_clause, where=None, params=None, batch_size=1000, pk="id", pause=0,
+             progress=None):
+    """Runs `UPDATE table SET set_clause` in pk ranges of batch_size, each range
+    committed on its own so row locks stay short. The last finished id is kept in
+    migration_backfills under `name`, so a failed or interrupted run resumes where it
+    stopped. A batch may run twice after a crash, so the update must be idempotent.
+    Progress is logged, or passed as (last_id, max_id) to `progress` if given."""
+    bind = op.get_bind()
+    statement = "UPDATE %s SET %s WHERE %s > :low AND %s <= :high" % (table_name, set_clause, pk, pk)
+    if where:
+        statement += " AND (%s)" % where
+
+    with op.get_context().autocommit_block():
+        last_id = _backfill_position(bind, name)
+        max_id = bind.execute(text("SELECT MAX(%s) FROM %s" % (pk, table_name))).scalar() or 0
+        while last_id < max_id:
+            high = min(last_id + batch_size, max_id)
+            bind.execute(text(statement), dict(params or {}, low=last_id, high=high))
+            bind.execute(text("UPDATE %s SET last_id = :high WHERE name = :name" % BACKFILL_TABLE),
+                         {"high": high, "name": name})
+            last_id = high
+            if progress is not None:
+                progress(last_id, max_id)
+            else:
+                logger.info("backfill %s: %s/%s", name, last_id, max_id)
+            if pause:
+                time.sleep(pause)
+
+
+def schema_drift():
+    """Differences between the models and the database, plus whether the database
+    is at the latest migration. Run against a database upgraded to head, any
+    difference means the models and migrations disagree."""
+    migrate = current_app.extensions['migrate']
+    config = Config()
+    config.set_main_option('script_location', migrate.directory)
+    heads = set(ScriptDirectory.from_config(config).get_heads())
+
+    def include_name(name, type_, parent_names):
+        return not (type_ == "table" and name in ("alembic_version", BACKFILL_TABLE))
+
+    def include_object(obj, name, type_, reflected, compare_to):
+        # A UNIQUE on the primary key is redundant: the models declare one that
+        # create_all leaves out, while the migrations create it
+        if type_ == "unique_constraint" and obj.table is not None:
+            primary_key = set(c.name for c in obj.table.primary_key.columns)
+            return set(c.name for c in obj.columns) != primary_key
+        return True
+
+    with migrate.db.engine.connect() as connection:
+        context = MigrationContext.configure(connection, opts={
+            "compare_type": True,
+            "include_name": include_name,
+            "include_object": include_object
+        })
+        current = set(context.get_current_heads())
+        diffs = compare_metadata(context, migrate.db.metadata)
+    return heads, current, diffs
+
+
+@schema_cli.command('check')
+def check_command():
+    """Exit with status 1 if the database is not at head or models have drifted."""
+    heads, current, diffs = schema_drift()
+    ok = True
+    if heads != current:
+        click.echo("Database at %s, migrations head is %s" % (sorted(current), sorted(heads)))
+        ok = False
+    for diff in diffs:
+        click.echo("Drift: %s" % (diff,))
+        ok = False
+    if not ok:
+        sys.exit(1)
+    click.echo("Schema matches models and migrations")
@@ -2,6 +2,7 @@ import enum
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import ForeignKey, Integer, String
 from dataclasses import dataclass,field
+from datetime import datetime
 
 db = SQLAlchemy()
 
@@ -31,8 +32,9 @@ class FavoritesType(str,enum.Enum):
 @dataclass
 class Favorites(db.Model):
     __tablename__ = 'favorites'
+    __table_args__ = (db.Index('ix_favorites_type_enum_external_id','type_enum','external_id'),)
     favorite_id:int = db.Column(db.Integer,unique=True, primary_key=True,index=True)
-    user_id:int = db.Column(db.Integer, ForeignKey('users.user_id'),nullable=False)
+    user_id:int = db.Column(db.Integer, ForeignKey('users.user_id'),nullable=False,index=True)
     external_id:int = db.Column(db.Integer,nullable=False)
     name:str = db.Column(db.String(50), unique=True,nullable=False)
     type_enum: FavoritesType = db.Column(db.Enum(FavoritesType), nullable=False)
@@ -67,4 +69,53 @@ class People(db.Model):
     skin_color:str = db.Column(db.String(50),nullable=False)
     hair_color:str = db.Column(db.String(50),nullable=False)
     height:int = db.Column(db.Integer,nullable=False)
-    homeworld:int = db.Column(db.Integer,ForeignKey('planets.id'),nullable=False)
\ No newline at end of file
+    homeworld:int = db.Column(db.Integer,ForeignKey('planets.id'),nullable=False,index=True)
+
+class JobStatus(str,enum.Enum):
+    queued = "queued"
+    running = "running"
+    done = "done"
+    failed = "failed"
+
+@dataclass
+class Jobs(db.Model):
+    __tablename__ = 'jobs'
+    id:int = db.Column(db.Integer,primary_key=True)
+    kind:str = db.Column(db.String(50),nullable=False)
+    status:JobStatus = db.Column(db.Enum(JobStatus),nullable=False,default=JobStatus.queued,index=True)
+    payload:dict = db.Column(db.JSON,nullable=True)
+    result:dict = db.Column(db.JSON,nullable=True)
+    error:str = db.Column(db.Text,nullable=True)
+    progress:int = db.Column(db.Integer,nullable=False,default=0)
+    attempts:int = db.Column(db.Integer,nullable=False,default=0)
+    max_attempts:int = db.Column(db.Integer,nullable=False,default=3)
+    locked_at = db.Column(db.DateTime,nullable=True)
+    created_at = db.Column(db.DateTime,nullable=False,default=datetime.utcnow)
+
+
+@dataclass
+class Changes(db.Model):
+    __tablename__ = 'changes'
+    __table_args__ = (
+        db.Index('ix_changes_table_name_row_id','table_name','row_id'),
+        db.Index('ix_changes_table_name_seq','table_name','seq'),
+    )
+    # Taken from ChangesCounter, not autoincrement, see changes.reserve_seqs
+    seq:int = db.Column(db.BigInteger().with_variant(db.Integer,"sqlite"),primary_key=True,autoincrement=False)
+    table_name:str = db.Column(db.String(20),nullable=False)
+    op:str = db.Column(db.String(10),nullable=False)
+    row_id:int = db.Column(db.Integer,nullable=False)
+    data:dict = db.Column(db.JSON,nullable=True)
+    user_id = db.Column(db.Integer,nullable=True,index=True)
+    created_at = db.Column(db.DateTime,nullable=False,server_default=db.func.now())
+
+class ChangesCounter(db.Model):
+    __tablename__ = 'changes_counter'
+    id = db.Column(db.Integer,primary_key=True,autoincrement=False)
+    seq = db.Column(db.BigInteger,nullable=False)
+
+class ChangesCompactions(db.Model):
+    __tablename__ = 'changes_compactions'
+    id = db.Column(db.Integer,primary_key=True)
+    purged_seq = db.Column(db.BigInteger,nullable=False)
+    compacted_at = db.Column(db.DateTime,nullable=False,server_default=db.func.now())
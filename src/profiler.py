@@ -0,0 +1,140 @@
+"""
+Opt-in sampling profiler. A fraction of requests (PROFILE_SAMPLE_RATE) is sampled
+by one background thread that reads the request thread's stack every
+PROFILE_INTERVAL seconds; samples are aggregated per route as collapsed stacks
+("frame;frame;frame count"), the input format of flamegraph.pl and speedscope.
+start_window() samples every thread of the worker for a while in the background.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import request
+
+# Distinct stacks kept per route, further new stacks are counted as "[truncated]"
+MAX_STACKS = 10000
+
+# Route name the worker-wide window is recorded under
+WORKER_ROUTE = "[worker]"
+
+_lock = threading.Lock()
+_active = {}
+_wakeup = threading.Event()
+_sampler = None
+_window = None
+# Request context nesting per thread, /batch dispatches sub-requests on the same thread
+_local = threading.local()
+profiles = {}
+
+
+def frame_stack(frame):
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    frames.reverse()
+    return ";".join(frames)
+
+
+def record(route, stack):
+    with _lock:
+        counter = profiles.setdefault(route, Counter())
+        if stack not in counter and len(counter) >= MAX_STACKS:
+            stack = "[truncated]"
+        counter[stack] += 1
+
+
+def _sample_loop(interval):
+    while True:
+        if not _active:
+            _wakeup.wait()
+            _wakeup.clear()
+            continue
+        frames = sys._current_frames()
+        for thread_id, route in list(_active.items()):
+            frame = frames.get(thread_id)
+            if frame is not None:
+                record(route, frame_stack(frame))
+        del frames
+        time.sleep(interval)
+
+
+def _ensure_sampler(interval):
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample_loop, args=(interval,), name="profiler", daemon=True)
+            _sampler.start()
+
+
+def _window_loop(seconds, interval):
+    me = threading.get_ident()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != me and thread_id != getattr(_sampler, "ident", None):
+                record(WORKER_ROUTE, frame_stack(frame))
+        time.sleep(interval)
+
+
+def start_window(seconds, interval):
+    """Samples every thread of this worker for `seconds` in the background, under
+    WORKER_ROUTE. Returns False if a window is already running."""
+    global _window
+    with _lock:
+        if _window is not None and _window.is_alive():
+            return False
+        _window = threading.Thread(target=_window_loop, args=(seconds, interval), name="profiler-window", daemon=True)
+        _window.start()
+    return True
+
+
+def collapsed(counters):
+    lines = []
+    for route, counter in counters.items():
+        for stack, count in counter.most_common():
+            lines.append("%s;%s %s" % (route, stack, count))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot(route=None):
+    with _lock:
+        if route is not None:
+            return {route: Counter(profiles.get(route, {}))}
+        return {name: Counter(counter) for name, counter in profiles.items()}
+
+
+def reset():
+    with _lock:
+        profiles.clear()
+
+
+def setup_profiler(app):
+    app.config.setdefault("PROFILE_SAMPLE_RATE", float(os.environ.get("PROFILE_SAMPLE_RATE", 0)))
+    app.config.setdefault("PROFILE_INTERVAL", float(os.environ.get("PROFILE_INTERVAL", 0.005)))
+    # The profile endpoints are disabled unless a token is configured
+    app.config.setdefault("PROFILE_TOKEN", os.environ.get("PROFILE_TOKEN"))
+
+    @app.before_request
+    def start_sampling():
+        _local.depth = getattr(_local, "depth", 0) + 1
+        # Nested contexts belong to the outer request's sample (or non-sample)
+        if _local.depth > 1:
+            return
+        rate = app.config["PROFILE_SAMPLE_RATE"]
+        if rate and random.random() < rate:
+            _ensure_sampler(app.config["PROFILE_INTERVAL"])
+            route = "%s %s" % (request.method, request.url_rule.rule if request.url_rule else "[unmatched]")
+            _active[threading.get_ident()] = route
+            _wakeup.set()
+
+    @app.teardown_request
+    def stop_sampling(exception=None):
+        _local.depth = getattr(_local, "depth", 1) - 1
+        if _local.depth <= 0:
+            _local.depth = 0
+            _active.pop(threading.get_ident(), None)
@@ -0,0 +1,20 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+# Never let the tests touch the database from the environment. Set
+# TEST_POSTGRES_URL to a throwaway local Postgres to run them there too.
+POSTGRES_URL = os.environ.get("TEST_POSTGRES_URL")
+os.environ["DATABASE_URL"] = POSTGRES_URL or "sqlite:///" + os.path.join(tempfile.mkdtemp(), "test.db")
+os.environ.pop("JOB_WORKERS", None)
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # Flask-Migrate finds the migrations directory relative to the cwd
+    monkeypatch.chdir(ROOT)
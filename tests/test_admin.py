@@ -0,0 +1,41 @@
+import pytest
+
+from app import app
+from models import db, Users, Favorites, FavoritesType, Planets, People
+
+
+def admin_view(model):
+    return next(v for v in app.extensions['admin'][0]._views if getattr(v, "model", None) is model)
+
+
+@pytest.fixture
+def database():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield
+        db.session.remove()
+        db.drop_all()
+
+
+def test_only_unique_or_pk_ordered_columns_are_sortable():
+    # type_enum leads ix_favorites_type_enum_external_id, which can't serve (type_enum, favorite_id)
+    assert set(admin_view(Favorites)._sortable_columns) == {"favorite_id", "name"}
+    assert set(admin_view(People)._sortable_columns) == {"id", "name"}
+
+
+def test_bulk_delete_of_people_removes_their_favorites(database):
+    db.session.add(Users(user_id=1, email="u@example.com", username="u", password="x"))
+    db.session.add(Planets(id=1, name="Tatooine", population=1, climate="c", diameter="d", gravity=1))
+    # No relationships between the models, so the flush doesn't order these inserts
+    db.session.commit()
+    db.session.add(People(id=1, name="Luke", species="s", skin_color="s", hair_color="h", height=1, homeworld=1))
+    db.session.add(Favorites(user_id=1, external_id=1, name="Luke", type_enum=FavoritesType.people))
+    db.session.commit()
+
+    with app.test_request_context():
+        # Flask-Admin passes the selected ids as strings
+        admin_view(People).action_delete(["1"])
+
+    assert People.query.count() == 0
+    assert Favorites.query.count() == 0
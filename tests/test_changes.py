@@ -0,0 +1,133 @@
+import threading
+import time
+
+import pytest
+from sqlalchemy import text
+
+from app import app
+from changes import compact, delete_resources
+from models import db, Changes, Films, Favorites, FavoritesType, Planets, Users
+
+
+@pytest.fixture
+def client():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
+        db.drop_all()
+
+
+def add_planet(name):
+    db.session.add(Planets(name=name, population=1, climate="c", diameter="d", gravity=1))
+    db.session.commit()
+
+
+def test_changes_are_sequenced_and_paged(client):
+    for name in ("a", "b", "c"):
+        add_planet(name)
+
+    body = client.get('/changes?since=0&limit=2').json
+    assert [change["seq"] for change in body["content"]] == [1, 2]
+    assert body["next"] == 2 and body["has_more"] is True
+
+    body = client.get('/changes?since=2').json
+    assert [change["seq"] for change in body["content"]] == [3]
+    assert body["has_more"] is False
+
+
+def test_limit_is_at_least_one(client):
+    add_planet("a")
+    add_planet("b")
+    body = client.get('/changes?limit=-5').json
+    assert [change["seq"] for change in body["content"]] == [1]
+
+
+def test_compaction_keeps_since_zero_and_reports_head(client):
+    for name in ("a", "b", "c"):
+        add_planet(name)
+    planet = Planets.query.filter_by(name="b").first()
+    db.session.delete(planet)
+    db.session.commit()
+    db.session.execute(text("UPDATE changes SET created_at = '2000-01-01 00:00:00'"))
+    db.session.commit()
+
+    compact(1)
+
+    # A fresh client gets the latest entry of every surviving row
+    body = client.get('/changes?since=0').json
+    assert [(c["table_name"], c["op"], c["data"]["name"]) for c in body["content"]] == [
+        ("planets", "insert", "a"), ("planets", "insert", "c")]
+
+    response = client.get('/changes?since=1')
+    assert response.status_code == 410
+    assert response.json["purged_seq"] == 4
+    assert response.json["head"] == 4
+
+
+def test_overlapping_writers_commit_in_seq_order(client):
+    if db.engine.dialect.name != "postgresql":
+        pytest.skip("SQLite never runs two writers at once")
+
+    # First writer reserves a seq and keeps its transaction open
+    db.session.add(Planets(name="first", population=1, climate="c", diameter="d", gravity=1))
+    db.session.flush()
+    first_seq = db.session.query(Changes.seq).scalar()
+
+    done = threading.Event()
+
+    def second_writer():
+        with app.app_context():
+            add_planet("second")
+        done.set()
+
+    thread = threading.Thread(target=second_writer)
+    thread.start()
+    # The second writer waits on the counter row instead of committing a higher seq first
+    assert not done.wait(0.5)
+    assert db.session.execute(text("SELECT count(*) FROM changes")).scalar() == 1
+    db.session.commit()
+    thread.join(5)
+    assert done.is_set()
+
+    seqs = [seq for (seq,) in db.session.query(Changes.seq).order_by(Changes.seq)]
+    assert seqs == [first_seq, first_seq + 1]
+
+
+def test_bulk_delete_records_favorites_committed_while_it_waits(client):
+    if db.engine.dialect.name != "postgresql":
+        pytest.skip("SQLite never runs two writers at once")
+
+    db.session.add(Users(user_id=1, email="u@example.com", username="u", password="x"))
+    db.session.add(Films(id=1, name="A New Hope", episode=4, release_date=1977, opening_crawl="o",
+                         director="d", producer="p"))
+    db.session.commit()
+    db.session.add(Favorites(user_id=1, external_id=1, name="first", type_enum=FavoritesType.films))
+    db.session.commit()
+
+    flushed = threading.Event()
+
+    def favorite_writer():
+        with app.app_context():
+            db.session.add(Favorites(user_id=1, external_id=1, name="second", type_enum=FavoritesType.films))
+            # Holds the counter lock until the commit
+            db.session.flush()
+            flushed.set()
+            time.sleep(0.5)
+            db.session.commit()
+
+    thread = threading.Thread(target=favorite_writer)
+    thread.start()
+    flushed.wait(5)
+    # Waits for the favorite, then records and deletes both
+    assert delete_resources("films", [1]) == 1
+    thread.join(5)
+
+    assert Favorites.query.count() == 0
+    tombstones = Changes.query.filter_by(table_name="favorites", op="delete").count()
+    assert tombstones == 2
+    # The next writer gets a fresh seq
+    add_planet("a")
+    seqs = [seq for (seq,) in db.session.query(Changes.seq).order_by(Changes.seq)]
+    assert seqs == list(range(1, len(seqs) + 1))
@@ -0,0 +1,102 @@
+from contextlib import contextmanager
+
+import pytest
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, inspect, text
+
+import migration_helpers
+from conftest import POSTGRES_URL
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def engine(request, tmp_path):
+    if request.param == "sqlite":
+        engine = create_engine("sqlite:///%s" % (tmp_path / "helpers.db"))
+    elif POSTGRES_URL:
+        engine = create_engine(POSTGRES_URL)
+    else:
+        pytest.skip("TEST_POSTGRES_URL not set")
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS helper_rows"))
+        connection.execute(text("DROP TABLE IF EXISTS %s" % migration_helpers.BACKFILL_TABLE))
+        connection.execute(text("CREATE TABLE helper_rows (id INTEGER PRIMARY KEY, value INTEGER NOT NULL)"))
+        for id in range(1, 26):
+            connection.execute(text("INSERT INTO helper_rows (id, value) VALUES (:id, 0)"), {"id": id})
+    yield engine
+    with engine.begin() as connection:
+        connection.execute(text("DROP TABLE IF EXISTS helper_rows"))
+        connection.execute(text("DROP TABLE IF EXISTS %s" % migration_helpers.BACKFILL_TABLE))
+    engine.dispose()
+
+
+@contextmanager
+def operations(engine):
+    with engine.connect() as connection:
+        with Operations.context(MigrationContext.configure(connection)):
+            yield connection
+        connection.commit()
+
+
+def index_names(engine):
+    return [index["name"] for index in inspect(engine).get_indexes("helper_rows")]
+
+
+def test_create_index_concurrently_is_idempotent(engine):
+    with operations(engine):
+        migration_helpers.create_index_concurrently("ix_helper_rows_value", "helper_rows", ["value"])
+        migration_helpers.create_index_concurrently("ix_helper_rows_value", "helper_rows", ["value"])
+    assert index_names(engine) == ["ix_helper_rows_value"]
+
+    with operations(engine):
+        migration_helpers.drop_index_concurrently("ix_helper_rows_value", "helper_rows")
+        migration_helpers.drop_index_concurrently("ix_helper_rows_value", "helper_rows")
+    assert index_names(engine) == []
+
+
+def test_backfill_updates_in_batches(engine):
+    calls = []
+    with operations(engine):
+        migration_helpers.backfill("bump", "helper_rows", "value = value + 1", batch_size=10,
+                                   progress=lambda last_id, max_id: calls.append((last_id, max_id)))
+    assert calls == [(10, 25), (20, 25), (25, 25)]
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT value FROM helper_rows GROUP BY value")).scalars().all() == [1]
+
+
+def test_backfill_resumes_after_interruption(engine):
+    def interrupt(last_id, max_id):
+        if last_id == 20:
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        with operations(engine):
+            migration_helpers.backfill("bump", "helper_rows", "value = value + 1", batch_size=10, progress=interrupt)
+
+    calls = []
+    with operations(engine):
+        migration_helpers.backfill("bump", "helper_rows", "value = value + 1", batch_size=10,
+                                   progress=lambda last_id, max_id: calls.append(last_id))
+    # Only the unfinished range ran again, the non-idempotent update hit every row once
+    assert calls == [25]
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT value FROM helper_rows GROUP BY value")).scalars().all() == [1]
+
+
+def test_create_index_concurrently_rebuilds_invalid_index(engine):
+    if engine.dialect.name != "postgresql":
+        pytest.skip("invalid indexes only exist on Postgres")
+    # A failed concurrent unique build leaves an INVALID index behind
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        with pytest.raises(Exception):
+            connection.execute(text("CREATE UNIQUE INDEX CONCURRENTLY ix_helper_rows_value ON helper_rows (value)"))
+        connection.execute(text("UPDATE helper_rows SET value = id"))
+
+    with operations(engine):
+        migration_helpers.create_index_concurrently("ix_helper_rows_value", "helper_rows", ["value"], unique=True)
+
+    with engine.connect() as connection:
+        valid = connection.execute(text(
+            "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+            "WHERE c.relname = 'ix_helper_rows_value'")).scalar()
+    assert valid is True
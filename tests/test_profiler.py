@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+import profiler
+from app import app
+from models import db
+
+
+@pytest.fixture
+def client():
+    app.config.update(PROFILE_SAMPLE_RATE=1.0, PROFILE_TOKEN="secret", PROFILE_INTERVAL=0.001)
+    profiler.reset()
+    with app.app_context():
+        db.create_all()
+        yield app.test_client()
+        db.session.remove()
+        db.drop_all()
+    app.config.update(PROFILE_SAMPLE_RATE=0.0, PROFILE_TOKEN=None)
+    profiler.reset()
+
+
+def test_profile_endpoints_need_the_token(client):
+    assert client.get('/profile').status_code == 404
+    assert client.post('/profile?seconds=1').status_code == 404
+    assert client.get('/profile', headers={"X-Profile-Token": "secret"}).status_code == 200
+
+
+def test_batch_sub_requests_keep_the_outer_sample(client, monkeypatch):
+    seen = []
+    monkeypatch.setattr(profiler, "_ensure_sampler", lambda interval: None)
+    original = app.view_functions["get_films"]
+
+    def get_films():
+        seen.append(dict(profiler._active))
+        return original()
+
+    monkeypatch.setitem(app.view_functions, "get_films", get_films)
+    client.post('/batch', json={"requests": [{"path": "/films"}, {"path": "/films"}]})
+
+    # Both sub-requests still ran under the outer /batch sample, and it ended with it
+    assert [list(active.values()) for active in seen] == [["POST /batch"], ["POST /batch"]]
+    assert profiler._active == {}
+
+
+def test_worker_window_runs_in_the_background(client):
+    headers = {"X-Profile-Token": "secret"}
+    started = time.time()
+    response = client.post('/profile?seconds=0.2', headers=headers)
+    assert response.status_code == 202
+    assert time.time() - started < 0.2
+    assert client.post('/profile?seconds=0.2', headers=headers).status_code == 409
+    assert client.post('/profile?seconds=1000', headers=headers).status_code == 400
+
+    time.sleep(0.3)
+    output = client.get('/profile?route=[worker]', headers=headers).text
+    assert output.startswith(profiler.WORKER_ROUTE + ";")